@@ -1,25 +1,43 @@
 # Run this as a single cell in Jupyter
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
+from pandas.api.types import is_scalar
+from openpyxl import Workbook, load_workbook
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import math
 import os
+import re
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # ---------- Helpers ----------
+_SENTINELS = frozenset(("", "na", "n/a", "-", "--"))
+_TRANS = str.maketrans({",": "", "%": "", "—": "", "−": "-"})
+_PAREN = re.compile(r"\((.+)\)")
+
 def safe_num(x):
     """Try to convert x to int/float, otherwise return None."""
     try:
         if x is None:
             return None
         s = str(x).strip()
-        if s == "" or s.lower() in ("na", "n/a", "-", "--"):
+        if s.lower() in _SENTINELS:
             return None
-        s = s.replace(",", "").replace("%", "").replace("—", "").replace("−", "-")
-        if s.startswith("(") and s.endswith(")"):
-            s = "-" + s[1:-1]
+        s = s.translate(_TRANS)
+        m = _PAREN.fullmatch(s)
+        if m:
+            s = "-" + m.group(1)
         f = float(s)
-        if math.isclose(f, int(f)):
+        if not math.isfinite(f):
+            return None
+        if f.is_integer():
             return int(f)
         return f
     except Exception:
@@ -35,9 +53,18 @@ headers = {
     "Content-Type": "application/json; charset=utf-8",
     "Accept": "application/json, text/javascript, */*; q=0.01",
     "X-Requested-With": "XMLHttpRequest",
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
+    "Connection": "keep-alive"
 }
 
+# ---------- HTTP session ----------
+# One keep-alive session so every endpoint reuses the same TCP/TLS connection
+session = requests.Session()
+session.headers.update(headers)
+adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4,
+                      max_retries=Retry(total=3, backoff_factor=0.5))
+session.mount("https://", adapter)
+
 # ---------- Column mappings ----------
 map_table1 = {
     "kse_index_type": "Name",
@@ -49,65 +76,150 @@ map_table1 = {
     "kse_index_change": "Change"
 }
 
+# Substring -> canonical name for the other tables; first match wins, so order matters
+_KEYS = (
+    ("sector", "SECTOR"),
+    ("code", "CODE"),
+    ("name", "NAME"),
+    ("open", "OPEN"),
+    ("high", "HIGH"),
+    ("low", "LOW"),
+    ("close", "CLOSE"),
+    ("vol", "VOLUME"),
+    ("change", "CHANGE"),
+)
+
+def normalize_columns(df):
+    """Rename df's columns in place to their canonical upper-case names."""
+    rename_map = {}
+    for src in df.columns:
+        low = src.lower()
+        canon = next((c for sub, c in _KEYS if sub in low), None)
+        if canon:
+            rename_map[src] = canon
+    df.rename(columns=rename_map, inplace=True)
+
 # ---------- Fetch & Save ----------
 excel_file = "PSX_DailyActivity.xlsx"
+scraped_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def fetch(table_name, url):
+    """POST one endpoint and return its normalized DataFrame (None if empty)."""
+    print(f"\n📡 Fetching {table_name} ...")
+    resp = session.post(url, timeout=30)
+    data_json = json_loads(resp.content)
+
+    if isinstance(data_json, dict) and "d" in data_json:
+        raw_list = data_json["d"]
+    elif isinstance(data_json, list):
+        raw_list = data_json
+    else:
+        raw_list = next((v for v in data_json.values() if isinstance(v, list)), None)
+
+    if not raw_list:
+        return None
 
-for table_name, url in endpoints.items():
+    df = pd.DataFrame(raw_list)
+
+    # Normalize columns
+    if table_name == "DailyActivity_1":
+        df.rename(columns=map_table1, inplace=True)
+    else:
+        normalize_columns(df)
+
+    # Add timestamp (broadcast once, shared by every table in this run)
+    df["ScrapedAt"] = scraped_at
+    return df
+
+def open_workbook():
+    """Load the existing workbook, or start an empty one on the first run."""
+    if os.path.exists(excel_file):
+        return load_workbook(excel_file)
+    wb = Workbook()
+    wb.remove(wb.active)
+    return wb
+
+def persist(wb, table_name, df):
+    """Append df to its sheet in wb, all-or-nothing. Must run on one thread only."""
+    # Two API keys can normalize to the same name (e.g. change/pchange -> CHANGE)
+    dups = df.columns[df.columns.duplicated()].unique().tolist()
+    if dups:
+        raise ValueError(f"duplicate columns after normalization: {dups}")
+
+    created = table_name not in wb.sheetnames
+    if created:
+        header = []
+    else:
+        header = [c.value for c in wb[table_name][1]]
+        while header and header[-1] is None:
+            header.pop()
+
+    # Line new rows up with the existing header, adding any new columns at the end
+    new_cols = [c for c in df.columns if c not in header]
+    header_len = len(header)
+    header = header + new_cols
+
+    # Build every row before touching the sheet, so a bad table writes nothing
+    out = df.reindex(columns=header).astype(object)
+    out = out.where(out.notna(), None)
+    # openpyxl rejects dict/list cells; stringify them like to_excel did
+    rows = [[v if is_scalar(v) else str(v) for v in row]
+            for row in out.itertuples(index=False, name=None)]
+
+    # Append only the new rows; existing history is never read back into pandas
+    ws = wb.create_sheet(table_name) if created else wb[table_name]
+    start_row = ws.max_row
     try:
-        print(f"\n📡 Fetching {table_name} ...")
-        resp = requests.post(url, headers=headers, timeout=30)
-        data_json = resp.json()
-
-        if isinstance(data_json, dict) and "d" in data_json:
-            raw_list = data_json["d"]
-        elif isinstance(data_json, list):
-            raw_list = data_json
-        else:
-            raw_list = next((v for v in data_json.values() if isinstance(v, list)), None)
-
-        if not raw_list:
-            print(f"⚠️ No data found for {table_name}")
-            continue
-
-        df = pd.DataFrame(raw_list)
-
-        # Normalize columns
-        if table_name == "DailyActivity_1":
-            df.rename(columns=map_table1, inplace=True)
-        else:
-            rename_map = {}
-            for src in df.columns:
-                low = src.lower()
-                if "sector" in low: rename_map[src] = "SECTOR"
-                elif "code" in low: rename_map[src] = "CODE"
-                elif "name" in low: rename_map[src] = "NAME"
-                elif "open" in low: rename_map[src] = "OPEN"
-                elif "high" in low: rename_map[src] = "HIGH"
-                elif "low" in low: rename_map[src] = "LOW"
-                elif "close" in low: rename_map[src] = "CLOSE"
-                elif "vol" in low: rename_map[src] = "VOLUME"
-                elif "change" in low: rename_map[src] = "CHANGE"
-            df.rename(columns=rename_map, inplace=True)
-
-        # Add timestamp
-        df["ScrapedAt"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        # Append data to Excel (if exists)
-        if os.path.exists(excel_file):
-            with pd.ExcelWriter(excel_file, mode="a", engine="openpyxl", if_sheet_exists="overlay") as writer:
-                try:
-                    old_df = pd.read_excel(excel_file, sheet_name=table_name)
-                    combined = pd.concat([old_df, df], ignore_index=True)
-                except Exception:
-                    combined = df
-                combined.to_excel(writer, index=False, sheet_name=table_name)
+        for i, col in enumerate(new_cols, start=header_len + 1):
+            ws.cell(row=1, column=i, value=col)
+        for row in rows:
+            ws.append(row)
+    except Exception:
+        # Roll back anything openpyxl accepted before the failure
+        if created:
+            wb.remove(ws)
         else:
-            with pd.ExcelWriter(excel_file, mode="w", engine="openpyxl") as writer:
-                df.to_excel(writer, index=False, sheet_name=table_name)
-
-        print(f"✅ Saved {len(df)} new rows to {table_name}")
-
+            if ws.max_row > start_row:
+                ws.delete_rows(start_row + 1, ws.max_row - start_row)
+            for i in range(header_len + 1, len(header) + 1):
+                ws.cell(row=1, column=i).value = None
+        raise
+
+# Fetch all endpoints in parallel; Excel writes stay serialized on this thread
+# and the workbook is loaded and saved once for the whole run
+try:
+    wb = open_workbook()
+except Exception as e:
+    # Still fetch, so each endpoint reports why it could not be saved
+    wb = None
+    open_error = e
+saved = {}
+with ThreadPoolExecutor(max_workers=len(endpoints)) as ex:
+    futures = {name: ex.submit(fetch, name, url) for name, url in endpoints.items()}
+    # Persist in endpoint order so sheet order and logs are stable between runs
+    for table_name, future in futures.items():
+        try:
+            df = future.result()
+            if df is None:
+                print(f"⚠️ No data found for {table_name}")
+                continue
+
+            if wb is None:
+                raise RuntimeError(f"cannot open {excel_file}: {open_error}")
+            persist(wb, table_name, df)
+            saved[table_name] = len(df)
+
+        except Exception as e:
+            print(f"❌ Error for {table_name}: {e}")
+
+session.close()
+
+if saved:
+    try:
+        wb.save(excel_file)
     except Exception as e:
-        print(f"❌ Error for {table_name}: {e}")
-
-print(f"\n📁 File saved as: {os.path.abspath(excel_file)}")
+        print(f"❌ Error saving {excel_file}: {e}")
+    else:
+        for table_name, n in saved.items():
+            print(f"✅ Saved {n} new rows to {table_name}")
+        print(f"\n📁 File saved as: {os.path.abspath(excel_file)}")